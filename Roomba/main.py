@@ -1,17 +1,32 @@
 import datetime
-import random
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from enum import IntEnum
-from typing import Optional, Tuple
+from itertools import repeat
+from typing import Optional
 import time
+import warnings
 import numpy as np
-import matplotlib as mlp
 import matplotlib.pyplot as plt
-from matplotlib import animation
-from mesa import DataCollector
-from mesa.agent import Agent
-from mesa.model import Model
-from mesa.space import MultiGrid
-from mesa.time import SimultaneousActivation
+import numba
+from numba import njit, prange
+
+# _randrange, _plan and _advance are mirrored by roomba_kernel.pyx, change both and bump this in both
+KERNEL_VERSION = 1
+
+try:
+    # Optional ahead-of-time kernel, see roomba_kernel.pyx
+    import roomba_kernel
+except ImportError:
+    native_tick = None
+else:
+    if getattr(roomba_kernel, 'KERNEL_VERSION', None) == KERNEL_VERSION:
+        native_tick = roomba_kernel.tick
+    else:
+        warnings.warn('roomba_kernel was built from a different roomba_kernel.pyx, rebuild it with '
+                      '`cythonize -i roomba_kernel.pyx`; using the Numba kernel instead')
+        native_tick = None
 
 
 class RoombaState(IntEnum):
@@ -25,216 +40,314 @@ class CellState(IntEnum):
     DIRTY = 1
 
 
-class RoombaAgent(Agent):
-    def __init__(self, unique_id: int, model: Model, grid: MultiGrid):
-        super().__init__(unique_id, model)
-
-        self.state = RoombaState.SEARCHING
-        self.next_state = None
-        self.grid = grid
-        self.next_pos: Optional[Tuple[int, int]] = None
-        self.negotiate_val: int = 0
-
-    def search_step(self) -> None:
-        neighbors = self.grid.get_neighbors(self.pos, moore=True, include_center=False)
-        for neighbor_cell in self.grid.iter_neighborhood(self.pos, moore=True, include_center=False):
-            cell_contents = self.grid.get_cell_list_contents([neighbor_cell])
-            cell_dirty = False
-            cell_occupied = False
-            for agent in cell_contents:
-                if isinstance(agent, CellAgent):
-                    cell_dirty = agent.state == CellState.DIRTY
-                elif isinstance(agent, RoombaAgent):
-                    cell_occupied = True
+# Moore neighborhood, in the same order the grid used to iterate it
+OFFSETS = np.array([(-1, -1), (-1, 0), (-1, 1),
+                    (0, -1), (0, 1),
+                    (1, -1), (1, 0), (1, 1)], dtype=np.int8)
+
+
+def build_neighbor_tables(width: int, height: int):
+    # In-bounds neighbors of every cell packed first, the rest are -1
+    xs, ys = np.meshgrid(np.arange(width, dtype=np.int32), np.arange(height, dtype=np.int32), indexing='ij')
+    nbr = np.stack((xs, ys), axis=-1)[:, :, None, :] + OFFSETS.astype(np.int32)
+    valid = ((nbr[..., 0] >= 0) & (nbr[..., 0] < width) &
+             (nbr[..., 1] >= 0) & (nbr[..., 1] < height))
+    # A stable sort moves the valid neighbors first and keeps the OFFSETS order among them
+    order = np.argsort(~valid, axis=2, kind='stable')
+    nbr_idx = np.take_along_axis(nbr, order[..., None], axis=2)
+    nbr_idx[~np.take_along_axis(valid, order, axis=2)] = -1
+    nbr_cnt = valid.sum(axis=2).astype(np.int8)
+    return nbr_idx, nbr_cnt
+
+
+@njit(cache=True)
+def _randrange(rng_state, i, n):
+    # splitmix64 step on the generator of roomba i, so roombas never share RNG state
+    z = rng_state[i] + np.uint64(0x9E3779B97F4A7C15)
+    rng_state[i] = z
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+    return np.int64(z % np.uint64(n))
+
+
+@njit(parallel=True, cache=True)
+def _plan(roomba_pos, roomba_state, negotiate_val, dirty_bits, occ, cell_best, cell_ties, nbr_idx, nbr_cnt,
+          rng_state, next_pos, next_state, next_val, cleans):
+    height = occ.shape[1]
+    roombas = roomba_pos.shape[0]
+
+    # Highest value among the negotiating roombas of every contested cell, and how many share it
+    for i in range(roombas):
+        if roomba_state[i] == RoombaState.NEGOTIATING:
+            cell_best[roomba_pos[i, 0], roomba_pos[i, 1]] = -1
+            cell_ties[roomba_pos[i, 0], roomba_pos[i, 1]] = 0
+    for i in range(roombas):
+        if roomba_state[i] == RoombaState.NEGOTIATING:
+            x = roomba_pos[i, 0]
+            y = roomba_pos[i, 1]
+            if negotiate_val[i] > cell_best[x, y]:
+                cell_best[x, y] = negotiate_val[i]
+                cell_ties[x, y] = 1
+            elif negotiate_val[i] == cell_best[x, y]:
+                cell_ties[x, y] += 1
+
+    # Every roomba only reads the state at the start of the tick and writes its own next_* row.
+    # This only runs on several threads when one simulation owns the process, main() runs
+    # replicates one per process with a single Numba thread each.
+    for i in prange(roombas):
+        x = roomba_pos[i, 0]
+        y = roomba_pos[i, 1]
+        next_pos[i, 0] = x
+        next_pos[i, 1] = y
+        next_state[i] = roomba_state[i]
+        next_val[i] = negotiate_val[i]
+        cleans[i] = 0
+
+        if roomba_state[i] == RoombaState.SEARCHING:
+            next_state[i] = RoombaState.SEARCHING
+            for k in range(nbr_cnt[x, y]):
+                nx = nbr_idx[x, y, k, 0]
+                ny = nbr_idx[x, y, k, 1]
+                idx = nx * height + ny
+                cell = np.int64((dirty_bits[idx >> 6] >> np.uint64(idx & 63)) & np.uint64(1))
+                if cell == CellState.DIRTY and occ[nx, ny] == 0:
+                    next_state[i] = RoombaState.CLEANING
+                    next_pos[i, 0] = nx
+                    next_pos[i, 1] = ny
                     break
-            if cell_dirty and not cell_occupied:
-                self.next_state = RoombaState.CLEANING
-                self.next_pos = neighbor_cell
-                return
-
-        selected_cells: int = random.randrange(0, len(neighbors))
-        self.next_state = RoombaState.SEARCHING
-        self.next_pos = neighbors[selected_cells].pos
-
-    def clean_step(self) -> None:
-        cell_contents = self.grid.get_cell_list_contents([self.pos])
-        cell_agent = None
-        for agent in cell_contents:
-            if isinstance(agent, RoombaAgent) and agent is not self:
-                self.transition_to_negotiation()
-                return
-            if isinstance(agent, CellAgent):
-                cell_agent = agent
-        cell_agent.state = CellState.CLEAN
-        self.next_state = RoombaState.SEARCHING
-        self.next_pos = self.pos
-
-    def transition_to_negotiation(self):
-        self.next_state = RoombaState.NEGOTIATING
-        self.next_pos = self.pos
-        self.negotiate_val = random.randrange(0, 100)
-
-    def negotiate_step(self) -> None:
-        cell_contents = self.grid.get_cell_list_contents([self.pos])
-        tied = False
-        won = True
-        for agent in cell_contents:
-            if isinstance(agent, RoombaAgent) and agent is not self:
-                if self.negotiate_val == agent.negotiate_val:
-                    tied = True
-                won = self.negotiate_val >= agent.negotiate_val
-
-        if won and tied:
-            self.transition_to_negotiation()
-        elif won:
-            self.next_state = RoombaState.CLEANING
-            self.next_pos = self.pos
-        else:
-            self.next_state = RoombaState.SEARCHING
-            self.next_pos = self.pos
-
-    def step(self) -> None:
-        if self.state == RoombaState.SEARCHING:
-            self.search_step()
-        elif self.state == RoombaState.NEGOTIATING:
-            self.negotiate_step()
-        elif self.state == RoombaState.CLEANING:
-            self.clean_step()
-
-    def advance(self) -> None:
-        self.grid.move_agent(self, self.next_pos)
-        self.state = self.next_state
-
-
-class CellAgent(Agent):
-    def __init__(self, unique_id: int, model: Model, grid: MultiGrid):
-        super().__init__(unique_id, model)
-
-        self.state = CellState.CLEAN
-        self.grid = grid
-
-
-class CleaningModel(Model):
-    def __init__(self, width: int, height: int, roombas: int, dirty_chance: float):
-        super().__init__()
 
+            if next_state[i] == RoombaState.SEARCHING:
+                k = _randrange(rng_state, i, nbr_cnt[x, y])
+                next_pos[i, 0] = nbr_idx[x, y, k, 0]
+                next_pos[i, 1] = nbr_idx[x, y, k, 1]
+
+        elif roomba_state[i] == RoombaState.NEGOTIATING:
+            won = negotiate_val[i] == cell_best[x, y]
+            tied = cell_ties[x, y] > 1
+
+            if won and tied:
+                next_state[i] = RoombaState.NEGOTIATING
+                next_val[i] = _randrange(rng_state, i, 100)
+            elif won:
+                next_state[i] = RoombaState.CLEANING
+            else:
+                next_state[i] = RoombaState.SEARCHING
+
+        elif roomba_state[i] == RoombaState.CLEANING:
+            if occ[x, y] > 1:
+                next_state[i] = RoombaState.NEGOTIATING
+                next_val[i] = _randrange(rng_state, i, 100)
+            else:
+                cleans[i] = 1
+                next_state[i] = RoombaState.SEARCHING
+
+
+@njit(cache=True)
+def _advance(roomba_pos, roomba_state, negotiate_val, dirty_bits, occ,
+             next_pos, next_state, next_val, cleans):
+    height = occ.shape[1]
+    # Applied serially, moves share the per-cell bookkeeping
+    for i in range(roomba_pos.shape[0]):
+        x = roomba_pos[i, 0]
+        y = roomba_pos[i, 1]
+        if cleans[i]:
+            idx = x * height + y
+            dirty_bits[idx >> 6] &= ~(np.uint64(1) << np.uint64(idx & 63))
+        nx = next_pos[i, 0]
+        ny = next_pos[i, 1]
+        occ[x, y] -= 1
+        occ[nx, ny] += 1
+        roomba_pos[i, 0] = next_pos[i, 0]
+        roomba_pos[i, 1] = next_pos[i, 1]
+        roomba_state[i] = next_state[i]
+        negotiate_val[i] = next_val[i]
+
+
+class CleaningModel:
+    def __init__(self, width: int, height: int, roombas: int, dirty_chance: float, steps: int,
+                 seed: Optional[int] = None):
         self.width = width
         self.height = height
-        self.roombas = roombas
-        self.num_agents = self.width * self.height
-        self.grid = MultiGrid(self.width, self.height, False)
+        # Roombas start one per cell from the beginning of the grid, so there can't be more than cells
+        self.roombas = min(roombas, width * height)
         self.dirty_chance = dirty_chance
-        self.data_collector = DataCollector(
-            model_reporters={"Cells": self.get_cell_grid,
-                             "Roombas": self.get_roomba_grid,
-                             'DirtyCells': self.dirty_cell_count}
-        )
-
-        self.schedule = SimultaneousActivation(self)
+        self.steps = steps
+        self.current_step = 0
+        self.seed = seed
+
+        # Structure of arrays: cells are plain state, roombas are indexed rows
+        # Cell x, y is bit (x * height + y) & 63 of word (x * height + y) >> 6
+        self.dirty_bits = np.zeros((self.width * self.height + 63) // 64, dtype=np.uint64)
+        self.roomba_pos = np.empty((self.roombas, 2), dtype=np.int32)
+        self.roomba_state = np.full(self.roombas, RoombaState.SEARCHING, dtype=np.int8)
+        self.negotiate_val = np.zeros(self.roombas, dtype=np.int32)
+        # Roomba count per cell, and the best negotiation value of each cell with how many share it
+        self.occ = np.zeros((self.width, self.height), dtype=np.uint8)
+        self.cell_best = np.full((self.width, self.height), -1, dtype=np.int32)
+        self.cell_ties = np.zeros((self.width, self.height), dtype=np.int32)
+        self.nbr_idx, self.nbr_cnt = build_neighbor_tables(self.width, self.height)
+        # One independent generator per roomba, plus one for the initial dirt
+        roomba_seq, dirt_seq = np.random.SeedSequence(self.seed).spawn(2)
+        self.rng_state = roomba_seq.generate_state(self.roombas, dtype=np.uint64)
+        self.rng = np.random.default_rng(dirt_seq)
+        # What every roomba planned for the current tick
+        self.next_pos = np.empty_like(self.roomba_pos)
+        self.next_state = np.empty_like(self.roomba_state)
+        self.next_val = np.empty_like(self.negotiate_val)
+        self.cleans = np.zeros(self.roombas, dtype=np.uint8)
+
+        # Snapshot of the grids and the dirty cell count at the start of every step
+        self.cells_hist = np.zeros((self.steps, self.width, self.height), dtype=np.uint8)
+        self.rooms_hist = np.zeros((self.steps, self.width, self.height), dtype=np.uint8)
+        self.dirty_hist = np.zeros(self.steps, dtype=np.int32)
 
         self.setup()
 
     def setup(self):
-        created_roombas = 0
-        for (content, x, y) in self.grid.coord_iter():
-            # Put the roombas at the start of the grid
-            if created_roombas < self.roombas:
-                roomba = RoombaAgent((x, y, 0), self, self.grid)
-                self.grid.place_agent(roomba, (x, y))
-                self.schedule.add(roomba)
-                created_roombas += 1
-
-            # Put a cell in every grid
-            cell = CellAgent((x, y, 1), self, self.grid)
-            if random.random() < self.dirty_chance:
-                cell.state = CellState.DIRTY
-            self.grid.place_agent(cell, (x, y))
-            self.schedule.add(cell)
+        # Put the roombas at the start of the grid
+        for i in range(self.roombas):
+            self.roomba_pos[i] = (i // self.height, i % self.height)
+            self.occ[i // self.height, i % self.height] += 1
+
+        dirty = self.rng.random((self.width, self.height)) < self.dirty_chance
+        # Bytes in little-endian bit order, read as little-endian words, keep the flat cell order on any host
+        packed = np.zeros(self.dirty_bits.size * 8, dtype=np.uint8)
+        bits = np.packbits(dirty.ravel(), bitorder='little')
+        packed[:bits.size] = bits
+        self.dirty_bits[:] = packed.view('<u8')
 
     def step(self):
-        self.data_collector.collect(self)
-        self.schedule.step()
+        self.collect()
+        self.current_step += 1
+        if native_tick is not None:
+            native_tick(self.roomba_pos, self.roomba_state, self.negotiate_val, self.dirty_bits, self.occ,
+                        self.cell_best, self.cell_ties, self.nbr_idx, self.nbr_cnt, self.rng_state,
+                        self.next_pos, self.next_state, self.next_val, self.cleans)
+            return
+
+        _plan(self.roomba_pos, self.roomba_state, self.negotiate_val, self.dirty_bits, self.occ,
+              self.cell_best, self.cell_ties, self.nbr_idx, self.nbr_cnt, self.rng_state,
+              self.next_pos, self.next_state, self.next_val, self.cleans)
+        _advance(self.roomba_pos, self.roomba_state, self.negotiate_val, self.dirty_bits, self.occ,
+                 self.next_pos, self.next_state, self.next_val, self.cleans)
+
+    def collect(self):
+        t = self.current_step
+        # The history only has room for the first `steps` steps, later ones keep simulating
+        if t >= self.steps:
+            return
+        self.cells_hist[t] = self.get_cell_grid()
+        self.rooms_hist[t, self.roomba_pos[:, 0], self.roomba_pos[:, 1]] = self.roomba_state
+        self.dirty_hist[t] = self.dirty_cell_count()
 
     def get_cell_grid(self):
-        grid = np.zeros((self.grid.width, self.grid.height))
-
-        for agents, x, y in self.grid.coord_iter():
-            for agent in agents:
-                if isinstance(agent, CellAgent):
-                    grid[x][y] = int(agent.state)
-
-        return grid
+        words = self.dirty_bits.astype('<u8', copy=False)
+        cells = np.unpackbits(words.view(np.uint8), count=self.width * self.height, bitorder='little')
+        return cells.reshape(self.width, self.height)
 
     def get_roomba_grid(self):
-        grid = np.zeros((self.grid.width, self.grid.height))
-
-        for agents, x, y in self.grid.coord_iter():
-            for agent in agents:
-                if isinstance(agent, RoombaAgent):
-                    grid[x][y] = int(agent.state)
-
+        grid = np.zeros((self.width, self.height), dtype=np.int8)
+        grid[self.roomba_pos[:, 0], self.roomba_pos[:, 1]] = self.roomba_state
         return grid
 
     def dirty_cell_count(self):
-        count = 0
-        for agents, x, y in self.grid.coord_iter():
-            for agent in agents:
-                if isinstance(agent, CellAgent):
-                    count += agent.state
-        return count
-
-
-def main():
-    GRID_SIZE = 15
-
-    NUM_GENERATIONS = 150
-
+        if hasattr(np, 'bitwise_count'):
+            return int(np.bitwise_count(self.dirty_bits).sum())
+        # NumPy < 2.0 has no popcount, count the unpacked bits instead
+        return int(np.unpackbits(self.dirty_bits.view(np.uint8)).sum())
+
+
+# RGB color of every cell and roomba state, used as lookup tables
+CELL_COLORS = np.array([[255, 255, 255],  # Clean
+                        [169, 169, 169]], dtype=np.uint8)  # Dirty
+ROOMBA_COLORS = np.array([[255, 255, 255],  # No roomba
+                          [50, 255, 50],  # Searching
+                          [255, 255, 50],  # negotiating
+                          [50, 50, 255]], dtype=np.uint8)  # cleaning
+CELL_PIXELS = 16
+SEPARATOR_PIXELS = 4
+
+
+def write_video(path: str, cells_hist: np.ndarray, rooms_hist: np.ndarray, fps: float):
+    # Cells on top of roombas, piped as raw RGB frames to ffmpeg
+    steps, width, height = cells_hist.shape
+    frame_size = f'{height * CELL_PIXELS}x{2 * width * CELL_PIXELS + SEPARATOR_PIXELS}'
+    try:
+        ffmpeg = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error',
+                                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', frame_size, '-r', str(fps),
+                                   '-i', '-', '-pix_fmt', 'yuv420p', path],
+                                  stdin=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RuntimeError(f'ffmpeg is needed to write {path} but it was not found in PATH') from None
+
+    separator = np.zeros((SEPARATOR_PIXELS, height * CELL_PIXELS, 3), dtype=np.uint8)
+    try:
+        for t in range(steps):
+            cells = CELL_COLORS[cells_hist[t]].repeat(CELL_PIXELS, axis=0).repeat(CELL_PIXELS, axis=1)
+            rooms = ROOMBA_COLORS[rooms_hist[t]].repeat(CELL_PIXELS, axis=0).repeat(CELL_PIXELS, axis=1)
+            ffmpeg.stdin.write(np.concatenate((cells, separator, rooms)).tobytes())
+        ffmpeg.stdin.close()
+    except BrokenPipeError:
+        # ffmpeg exited early, its exit status is reported below
+        pass
+
+    status = ffmpeg.wait()
+    if status != 0:
+        raise RuntimeError(f'ffmpeg could not write {path}, exit status {status}')
+
+
+GRID_SIZE = 15
+NUM_GENERATIONS = 150
+NUM_RUNS = 8
+
+
+def run_one(seed: int, dirty_chance: float, roombas: int, keep_frames: bool):
+    # Timed like the single simulation main() used to run, without the worker startup
     start_time = time.time()
-
-    model = CleaningModel(GRID_SIZE, GRID_SIZE, 4, 0.5)
+    model = CleaningModel(GRID_SIZE, GRID_SIZE, roombas, dirty_chance, NUM_GENERATIONS, seed=seed)
 
     for i in range(NUM_GENERATIONS):
         model.step()
-    final_time = time.time()
+    elapsed = time.time() - start_time
 
-    print('Execution time:', str(datetime.timedelta(seconds=(final_time - start_time))))
+    # Only send the frames back when they are going to be rendered
+    if not keep_frames:
+        return None, None, model.dirty_hist, elapsed
+    return model.cells_hist, model.rooms_hist, model.dirty_hist, elapsed
 
-    model_data = model.data_collector.get_model_vars_dataframe()
 
-    fig, axs = plt.subplots(nrows=3, ncols=1, figsize=(7, 7))
+def main(entropy: Optional[int] = None):
+    # Fresh seeds every invocation, pass the printed entropy to repeat a run
+    seed_seq = np.random.SeedSequence(entropy)
+    print('Seed entropy:', seed_seq.entropy)
+    seeds = [int(seed) for seed in seed_seq.generate_state(NUM_RUNS)]
+    keep_frames = [True] + [False] * (NUM_RUNS - 1)
 
-    axs[0].set_xticks([])
-    axs[0].set_yticks([])
-    axs[1].set_xticks([])
-    axs[1].set_yticks([])
-
-    roomba_colors = []
-    cell_colors = []
-    roomba_colors.append(np.array([255 / 255, 255 / 255, 255 / 255, 1]))  # No roomba
-    roomba_colors.append(np.array([50 / 255, 255 / 255, 50 / 255, 1]))  # Searching
-    roomba_colors.append(np.array([255 / 255, 255 / 255, 50 / 255, 1]))  # negotiating
-    roomba_colors.append(np.array([50 / 255, 50 / 255, 255 / 255, 1]))  # cleaning
-    cell_colors.append(np.array([255 / 255, 255 / 255, 255 / 255, 1]))  # Clean
-    cell_colors.append(np.array([169 / 255, 169 / 255, 169 / 255, 1]))  # Dirty
-    roomba_cmap = mlp.colors.ListedColormap(roomba_colors)
-    cell_cmap = mlp.colors.ListedColormap(cell_colors)
+    start_time = time.time()
 
-    cells_plot = axs[0].imshow(model.get_cell_grid(), cmap=cell_cmap, vmin=0, vmax=1)
-    axs[0].set_title('Cells')
-    roombas_plot = axs[1].imshow(model.get_roomba_grid(), cmap=roomba_cmap, vmin=0, vmax=3)
-    axs[1].set_title('Roombas')
-    model_data['DirtyCells'].iloc[[0]].plot(ax=axs[2])
-    axs[2].set_title('Dirty cell count')
+    # Independent replicates, one process each. Each worker gets one Numba thread, which turns off
+    # the prange parallelism inside a run; the threads would only compete for the same cores
+    with ProcessPoolExecutor(initializer=numba.set_num_threads, initargs=(1,)) as executor:
+        runs = list(executor.map(run_one, seeds, repeat(0.5), repeat(4), keep_frames))
+    final_time = time.time()
 
-    def animate(i):
-        roombas_plot.set_data(model_data['Roombas'].iloc[i // 2])
-        cells_plot.set_data(model_data['Cells'].iloc[i // 2])
-        model_data['DirtyCells'].iloc[0:(i // 2)].plot(ax=axs[2])
+    run_time = sum(elapsed for *_, elapsed in runs) / NUM_RUNS
+    print('Execution time (mean per simulation):', str(datetime.timedelta(seconds=run_time)))
+    print(f'Wall time ({NUM_RUNS} replicates, incl. worker startup):',
+          str(datetime.timedelta(seconds=(final_time - start_time))))
 
-    roomba_anim = animation.FuncAnimation(fig, animate, frames=NUM_GENERATIONS * 2)
+    # 400 ms per generation, the speed of the former Matplotlib animation
+    cells_hist, rooms_hist, _, _ = runs[0]
+    write_video("animation.mp4", cells_hist, rooms_hist, fps=2.5)
 
-    roomba_anim.save("animation.mp4")
+    fig, ax = plt.subplots(figsize=(7, 3))
+    for _, _, dirty_hist, _ in runs:
+        ax.plot(dirty_hist)
+    ax.set_xlim(0, NUM_GENERATIONS)
+    ax.set_title('Dirty cell count')
+    fig.savefig("dirty_cells.png")
 
 
 if __name__ == '__main__':
-    main()
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else None)
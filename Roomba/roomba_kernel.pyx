@@ -0,0 +1,122 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+# Ahead-of-time compiled version of the tick in main.py, build with `cythonize -i roomba_kernel.pyx`
+# This duplicates _randrange, _plan and _advance in main.py by hand: any change must go into both
+# kernels, and KERNEL_VERSION must be bumped in both files so stale builds are rejected at import.
+from libc.stdint cimport uint64_t
+
+# Same values as CellState and RoombaState in main.py
+cdef enum:
+    CLEAN = 0
+    DIRTY = 1
+
+cdef enum:
+    SEARCHING = 1
+    NEGOTIATING = 2
+    CLEANING = 3
+
+KERNEL_VERSION = 1
+
+
+cdef inline int _randrange(uint64_t[::1] rng_state, Py_ssize_t i, int n) noexcept nogil:
+    # splitmix64 step on the generator of roomba i, same sequence as the Numba kernel
+    cdef uint64_t z = rng_state[i] + 0x9E3779B97F4A7C15ULL
+    rng_state[i] = z
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    z = z ^ (z >> 31)
+    return <int> (z % <uint64_t> n)
+
+
+cdef void _tick(int[:, ::1] roomba_pos, signed char[::1] roomba_state, int[::1] negotiate_val,
+                uint64_t[::1] dirty_bits, unsigned char[:, ::1] occ,
+                int[:, ::1] cell_best, int[:, ::1] cell_ties,
+                int[:, :, :, ::1] nbr_idx, signed char[:, ::1] nbr_cnt, uint64_t[::1] rng_state,
+                int[:, ::1] next_pos, signed char[::1] next_state, int[::1] next_val,
+                unsigned char[::1] cleans) noexcept nogil:
+    cdef Py_ssize_t i, k, idx
+    cdef Py_ssize_t height = occ.shape[1]
+    cdef int x, y, nx, ny
+
+    # Highest value among the negotiating roombas of every contested cell, and how many share it
+    for i in range(roomba_pos.shape[0]):
+        if roomba_state[i] == NEGOTIATING:
+            cell_best[roomba_pos[i, 0], roomba_pos[i, 1]] = -1
+            cell_ties[roomba_pos[i, 0], roomba_pos[i, 1]] = 0
+    for i in range(roomba_pos.shape[0]):
+        if roomba_state[i] == NEGOTIATING:
+            x = roomba_pos[i, 0]
+            y = roomba_pos[i, 1]
+            if negotiate_val[i] > cell_best[x, y]:
+                cell_best[x, y] = negotiate_val[i]
+                cell_ties[x, y] = 1
+            elif negotiate_val[i] == cell_best[x, y]:
+                cell_ties[x, y] += 1
+
+    # Every roomba decides from the state at the start of the tick
+    for i in range(roomba_pos.shape[0]):
+        x = roomba_pos[i, 0]
+        y = roomba_pos[i, 1]
+        next_pos[i, 0] = x
+        next_pos[i, 1] = y
+        next_state[i] = roomba_state[i]
+        next_val[i] = negotiate_val[i]
+        cleans[i] = 0
+
+        if roomba_state[i] == SEARCHING:
+            for k in range(nbr_cnt[x, y]):
+                nx = nbr_idx[x, y, k, 0]
+                ny = nbr_idx[x, y, k, 1]
+                idx = nx * height + ny
+                if ((dirty_bits[idx >> 6] >> (idx & 63)) & 1) == DIRTY and occ[nx, ny] == 0:
+                    next_state[i] = CLEANING
+                    next_pos[i, 0] = nx
+                    next_pos[i, 1] = ny
+                    break
+
+            if next_state[i] == SEARCHING:
+                k = _randrange(rng_state, i, nbr_cnt[x, y])
+                next_pos[i, 0] = nbr_idx[x, y, k, 0]
+                next_pos[i, 1] = nbr_idx[x, y, k, 1]
+
+        elif roomba_state[i] == NEGOTIATING:
+            if negotiate_val[i] == cell_best[x, y] and cell_ties[x, y] > 1:
+                next_val[i] = _randrange(rng_state, i, 100)
+            elif negotiate_val[i] == cell_best[x, y]:
+                next_state[i] = CLEANING
+            else:
+                next_state[i] = SEARCHING
+
+        elif roomba_state[i] == CLEANING:
+            if occ[x, y] > 1:
+                next_state[i] = NEGOTIATING
+                next_val[i] = _randrange(rng_state, i, 100)
+            else:
+                cleans[i] = 1
+                next_state[i] = SEARCHING
+
+    # Advance every roomba to its planned state
+    for i in range(roomba_pos.shape[0]):
+        x = roomba_pos[i, 0]
+        y = roomba_pos[i, 1]
+        if cleans[i]:
+            idx = x * height + y
+            dirty_bits[idx >> 6] &= ~(<uint64_t> 1 << (idx & 63))
+        nx = next_pos[i, 0]
+        ny = next_pos[i, 1]
+        occ[x, y] -= 1
+        occ[nx, ny] += 1
+        roomba_pos[i, 0] = nx
+        roomba_pos[i, 1] = ny
+        roomba_state[i] = next_state[i]
+        negotiate_val[i] = next_val[i]
+
+
+def tick(int[:, ::1] roomba_pos, signed char[::1] roomba_state, int[::1] negotiate_val,
+         uint64_t[::1] dirty_bits, unsigned char[:, ::1] occ,
+         int[:, ::1] cell_best, int[:, ::1] cell_ties,
+         int[:, :, :, ::1] nbr_idx, signed char[:, ::1] nbr_cnt, uint64_t[::1] rng_state,
+         int[:, ::1] next_pos, signed char[::1] next_state, int[::1] next_val,
+         unsigned char[::1] cleans):
+    with nogil:
+        _tick(roomba_pos, roomba_state, negotiate_val, dirty_bits, occ, cell_best, cell_ties,
+              nbr_idx, nbr_cnt, rng_state, next_pos, next_state, next_val, cleans)